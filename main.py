@@ -1,40 +1,42 @@
 # main.py
 
 import enum
-import json
+import gzip
+import hashlib
+import math
+import orjson
 import os
+import sys
+import time
 import uvicorn
+from collections import OrderedDict, defaultdict
 from contextlib import asynccontextmanager
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
-from fastapi import Depends, FastAPI, HTTPException, Request
-from pydantic import BaseModel
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.errors import RateLimitExceeded
-from slowapi.util import get_remote_address
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, TypeAdapter
+from limits import parse
+from limits.storage import storage_from_string
+from limits.aio.strategies import MovingWindowRateLimiter
+from limits.errors import StorageError
 from sqlmodel import Field, Session, SQLModel, create_engine, select
-from sqlalchemy import JSON, Column
+from sqlalchemy import event, inspect
+from typing_extensions import TypedDict
+
+try:
+    import brotli
+except ImportError:  # Optional: without it the catalog is offered as gzip only.
+    brotli = None
 
 # --- Lifespan Manager Function ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Handles application startup and shutdown events."""
     print("Lifespan event: Application startup...")
-    create_db_and_tables()
+    init_db()
     with Session(engine) as session:
-        if not session.exec(select(Item)).first():
-            print("Database is empty, populating...")
-            try:
-                with open("items_data.json", "r") as f:
-                    items_data = json.load(f)
-                    for item_data in items_data:
-                        session.add(Item(**item_data))
-                    session.commit()
-                print("Database populated successfully.")
-            except FileNotFoundError:
-                print("Warning: items_data.json not found. Database will be empty.")
-            except Exception as e:
-                print(f"An error occurred while populating the database: {e}")
+        build_response_caches(app, session)
     yield
     print("Lifespan event: Application shutdown.")
 
@@ -44,24 +46,143 @@ app = FastAPI(
     title="Dune: Awakening Crafting API",
     description="A lightweight API for all craftable items, including buildings and vehicles.",
     version="1.5.1", # Final, working version
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
 # --- Rate Limiter Setup ---
-limiter = Limiter(key_func=get_remote_address)
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+# Counters live in process memory by default. Point RATE_LIMIT_STORAGE_URI at a
+# shared Redis (e.g. "redis://localhost:6379/0") so multiple workers/instances
+# enforce one quota per client instead of one per process.
+rate_limit_storage_uri = os.environ.get("RATE_LIMIT_STORAGE_URI")
+shared_rate_limiter = (
+    MovingWindowRateLimiter(storage_from_string(
+        f"async+{rate_limit_storage_uri}", implementation="redispy", wrap_exceptions=True
+    ))
+    if rate_limit_storage_uri else None
+)
+
+class RateLimit:
+    """Dependency allowing `limit` (e.g. "20/minute") requests per client IP.
+
+    Each client gets a token bucket holding up to `limit` tokens and refilled
+    continuously over the period; only the `max_clients` most recently seen
+    clients are kept. With shared storage configured, a moving window in that
+    store is used instead, falling back to the local buckets if it is unreachable.
+    """
+    # After the shared store fails, every limit uses its local buckets for this
+    # long before trying the store again.
+    SHARED_STORAGE_COOLDOWN = 30.0  # seconds
+    shared_storage_failed_at: Optional[float] = None
+
+    def __init__(self, limit: str, max_clients: int = 10_000):
+        self.limit = parse(limit)
+        self.capacity = self.limit.amount
+        self.refill_rate = self.limit.amount / self.limit.get_expiry()  # tokens per second
+        self.max_clients = max_clients
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()  # client -> (tokens, last refill)
+
+    def take_local(self, client: str) -> float:
+        """Takes a token from the client's bucket; returns 0, or seconds until one is available."""
+        now = time.monotonic()
+        tokens, last_refill = self.buckets.pop(client, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - last_refill) * self.refill_rate)
+        if tokens >= 1:
+            tokens -= 1
+            retry_after = 0.0
+        else:
+            retry_after = (1 - tokens) / self.refill_rate
+        self.buckets[client] = (tokens, now)
+        if len(self.buckets) > self.max_clients:
+            self.buckets.popitem(last=False)
+        return retry_after
+
+    async def take_shared(self, scope: str, client: str) -> float:
+        """Records a hit in the shared store; returns 0, or seconds until the window frees up."""
+        if await shared_rate_limiter.hit(self.limit, scope, client):
+            return 0.0
+        window = await shared_rate_limiter.get_window_stats(self.limit, scope, client)
+        return max(window.reset_time - time.time(), 1.0)
+
+    async def __call__(self, request: Request):
+        client = request.client.host if request.client else "127.0.0.1"
+        retry_after = None
+        failed_at = RateLimit.shared_storage_failed_at
+        if shared_rate_limiter is not None and (
+            failed_at is None or time.monotonic() - failed_at >= self.SHARED_STORAGE_COOLDOWN
+        ):
+            try:
+                retry_after = await self.take_shared(request.scope["route"].path, client)
+                RateLimit.shared_storage_failed_at = None
+            except StorageError:
+                RateLimit.shared_storage_failed_at = time.monotonic()
+        if retry_after is None:
+            retry_after = self.take_local(client)
+        if retry_after:
+            raise HTTPException(
+                status_code=429,
+                detail=f"Rate limit exceeded: {self.limit}",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
 
 # --- Database Setup ---
 sqlite_file_name = "dune_crafting.db"
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 engine = create_engine(sqlite_url, connect_args={"check_same_thread": False})
 
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets concurrent readers proceed without blocking on the startup writer.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-65536")  # 64 MiB
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
 
+def init_db():
+    """Creates the tables and seeds them from items_data.json if they are empty."""
+    # Databases from before the itemmaterial table kept materials in a JSON column
+    # on item; they are never reseeded, so every item would be served without materials.
+    inspector = inspect(engine)
+    if inspector.has_table("item") and "crafting_materials" in {column["name"] for column in inspector.get_columns("item")}:
+        raise RuntimeError(
+            f"{sqlite_file_name} uses the old layout with materials stored on the item table. "
+            "Delete it and restart to rebuild the database from items_data.json."
+        )
+    create_db_and_tables()
+    with Session(engine) as session:
+        if not session.exec(select(Item)).first():
+            print("Database is empty, populating...")
+            try:
+                with open("items_data.json", "rb") as f:
+                    # One pass in pydantic-core: decodes, validates and yields plain dicts.
+                    items_data = item_seed_adapter.validate_json(f.read())
+                # Plain inserts: skips per-row model construction and the ORM unit of work.
+                # return_defaults fills in each item's "id" for its material rows.
+                session.bulk_insert_mappings(Item, items_data, return_defaults=True)
+                session.bulk_insert_mappings(ItemMaterial, [
+                    {"item_id": item_data["id"], **mat}
+                    for item_data in items_data
+                    for mat in item_data["crafting_materials"]
+                ])
+                session.commit()
+                print("Database populated successfully.")
+            except FileNotFoundError:
+                print("Warning: items_data.json not found. Database will be empty.")
+            except Exception as e:
+                session.rollback()
+                print(f"An error occurred while populating the database: {e}")
+
 # --- Data Models ---
+# Schema-only: materials are stored as ItemMaterial rows and served as
+# pre-serialized dicts, so this model is never instantiated on the request path.
 class CraftingMaterial(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
     item_name: str
     quantity: int
 
@@ -76,59 +197,233 @@ class Item(SQLModel, table=True):
     item_type: ItemType
     power_consumption: int = Field(default=0)
     power_generation: int = Field(default=0)
-    crafting_materials: List[CraftingMaterial] = Field(sa_column=Column(JSON))
+
+class ItemMaterial(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    item_id: int = Field(foreign_key="item.id", index=True)
+    item_name: str
+    quantity: int
+
+# Seed rows validate straight into plain dicts for bulk_insert_mappings; each
+# item's crafting_materials are split out into ItemMaterial rows.
+class CraftingMaterialSeed(TypedDict):
+    item_name: str
+    quantity: int
+
+class ItemSeed(TypedDict):
+    name: str; description: str; item_type: ItemType
+    power_consumption: int; power_generation: int
+    crafting_materials: List[CraftingMaterialSeed]
+
+item_seed_adapter = TypeAdapter(List[ItemSeed])
 
 class ItemResponse(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
     id: int; name: str; description: str; item_type: ItemType
     power_consumption: int; power_generation: int
     crafting_materials: List[CraftingMaterial]
     deep_desert_materials: List[CraftingMaterial]
 
-# --- Database Session Dependency ---
-def get_db():
-    with Session(engine) as session:
-        yield session
+# --- Response Cache Helpers ---
+def make_etag(content: bytes) -> str:
+    return f'"{hashlib.sha256(content).hexdigest()}"'
 
-# --- API Endpoints Helper ---
-def create_item_response(db_item: Item) -> ItemResponse:
-    dd_materials = [
-        CraftingMaterial(item_name=mat['item_name'], quantity=(mat['quantity'] + 1) // 2)
-        for mat in db_item.crafting_materials
-    ]
-    return ItemResponse(**db_item.dict(), deep_desert_materials=dd_materials)
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison (RFC 9110 13.1.2): a W/ prefix on either tag is ignored."""
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith("W/") else tag) == opaque_tag:
+            return True
+    return False
+
+def compress_variants(content: bytes) -> dict:
+    """Precompresses `content` once, mapping each content-coding to (body, etag)."""
+    variants = {}
+    if brotli is not None:
+        variants["br"] = brotli.compress(content, quality=11)
+    variants["gzip"] = gzip.compress(content, 9, mtime=0)  # no timestamp: stable bytes and ETag
+    return {encoding: (body, make_etag(body)) for encoding, body in variants.items()}
+
+def accepted_encodings(accept_encoding: str, available) -> set:
+    """Returns the codings in `available` that an Accept-Encoding header allows.
+
+    Codings are matched case-insensitively, those refused with q=0 are left out,
+    and "*" stands for every coding the header doesn't name.
+    """
+    qualities = {}
+    for part in accept_encoding.split(","):
+        coding, *params = part.split(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    wildcard = qualities.get("*", 0.0)
+    return {coding for coding in available if qualities.get(coding, wildcard) > 0}
+
+def cached_json_response(request: Request, content: bytes, etag: str, compressed: Optional[dict] = None) -> Response:
+    """Returns cacheable JSON, or an empty 304 if the client already has this version.
+
+    If `compressed` (from compress_variants) is given, the first encoding the
+    client accepts is served instead of the identity body.
+    """
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=3600"}
+    if compressed:
+        headers["Vary"] = "Accept-Encoding"
+        accepted = accepted_encodings(request.headers.get("accept-encoding", ""), compressed)
+        for encoding, (encoded_content, encoded_etag) in compressed.items():
+            if encoding in accepted:
+                content, etag = encoded_content, encoded_etag
+                headers["ETag"] = etag
+                headers["Content-Encoding"] = encoding
+                break
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type="application/json", headers=headers)
+
+def build_response_caches(app: FastAPI, session: Session):
+    """Serializes every item response once; item data only changes at startup."""
+    # Plain column selects return Row tuples, skipping ORM hydration and the
+    # identity map; materials for all items come back in one second query.
+    materials_by_item = defaultdict(list)
+    material_rows = session.exec(
+        select(ItemMaterial.item_id, ItemMaterial.item_name, ItemMaterial.quantity).order_by(ItemMaterial.id)
+    )
+    for item_id, item_name, quantity in material_rows:
+        materials_by_item[item_id].append((item_name, quantity))
+
+    # Only the serialized bytes and the search column outlive this function.
+    ids, item_names_lc, items_json_rows = [], [], []
+    item_rows = session.exec(
+        select(
+            Item.id, Item.name, Item.description, Item.item_type,
+            Item.power_consumption, Item.power_generation,
+        ).order_by(Item.id)
+    )
+    for item_id, name, description, item_type, power_consumption, power_generation in item_rows:
+        materials = materials_by_item[item_id]
+        ids.append(item_id)
+        item_names_lc.append(name.lower())
+        items_json_rows.append(orjson.dumps({
+            "id": item_id,
+            "name": name,
+            "description": description,
+            "item_type": item_type,
+            "power_consumption": power_consumption,
+            "power_generation": power_generation,
+            "crafting_materials": [
+                {"item_name": item_name, "quantity": quantity} for item_name, quantity in materials
+            ],
+            "deep_desert_materials": [
+                {"item_name": item_name, "quantity": (quantity + 1) // 2} for item_name, quantity in materials
+            ],
+        }))
+
+    app.state.items_json_cache = b"[" + b",".join(items_json_rows) + b"]"
+    app.state.items_etag = make_etag(app.state.items_json_cache)
+    app.state.items_compressed = compress_variants(app.state.items_json_cache)
+    app.state.items_by_id_cache = dict(zip(ids, items_json_rows))
+    app.state.item_etags_by_id = {item_id: make_etag(item_json) for item_id, item_json in zip(ids, items_json_rows)}
+    app.state.items_json_rows = items_json_rows
+    app.state.item_names_lc = item_names_lc
 
 # --- API Endpoints ---
 @app.get("/", summary="Root Welcome Message")
-def read_root():
+async def read_root():
     return {"message": "Welcome to the Dune: Awakening Crafting API!"}
 
-@app.get("/api/v1/items", response_model=List[ItemResponse], summary="Get All Craftable Items")
-@limiter.limit("20/minute")
-def get_all_items(request: Request, db: Session = Depends(get_db)):
-    return [create_item_response(db_item) for db_item in db.exec(select(Item)).all()]
+# Handlers return pre-serialized responses to skip response_model re-validation;
+# the models are still advertised in the OpenAPI schema via `responses=`.
+@app.get(
+    "/api/v1/items",
+    responses={200: {"model": List[ItemResponse]}},
+    dependencies=[Depends(RateLimit("20/minute"))],
+    summary="Get All Craftable Items",
+)
+async def get_all_items(request: Request):
+    return cached_json_response(
+        request, app.state.items_json_cache, app.state.items_etag, app.state.items_compressed
+    )
 
-@app.get("/api/v1/items/{item_id}", response_model=ItemResponse, summary="Get Item by ID")
-@limiter.limit("60/minute")
-def get_item_by_id(request: Request, item_id: int, db: Session = Depends(get_db)):
-    db_item = db.get(Item, item_id)
-    if not db_item:
+@app.get(
+    "/api/v1/items/{item_id}",
+    responses={200: {"model": ItemResponse}},
+    dependencies=[Depends(RateLimit("60/minute"))],
+    summary="Get Item by ID",
+)
+async def get_item_by_id(request: Request, item_id: int):
+    cached_item = app.state.items_by_id_cache.get(item_id)
+    if cached_item is None:
         raise HTTPException(status_code=404, detail=f"Item with ID {item_id} not found")
-    return create_item_response(db_item)
+    return cached_json_response(request, cached_item, app.state.item_etags_by_id[item_id])
 
-@app.get("/api/v1/items/search/", response_model=List[ItemResponse], summary="Search for Items by Name")
-@limiter.limit("10/minute")
-def search_items_by_name(request: Request, name: str, db: Session = Depends(get_db)):
-    results = db.exec(select(Item).where(Item.name.ilike(f"%{name}%"))).all()
-    if not results:
+@app.get(
+    "/api/v1/items/search/",
+    responses={200: {"model": List[ItemResponse]}},
+    dependencies=[Depends(RateLimit("10/minute"))],
+    summary="Search for Items by Name",
+)
+async def search_items_by_name(request: Request, name: str):
+    query = name.lower()
+    hits = [
+        item_json
+        for item_name, item_json in zip(app.state.item_names_lc, app.state.items_json_rows)
+        if query in item_name
+    ]
+    if not hits:
         raise HTTPException(status_code=404, detail=f"No items found with the name '{name}'")
-    return [create_item_response(db_item) for db_item in results]
+    content = b"[" + b",".join(hits) + b"]"
+    return cached_json_response(request, content, make_etag(content))
+
+# `python main.py` loads this file as __main__ (and as __mp_main__ in spawned
+# workers). Alias it so uvicorn's "main:app" import reuses this module instead of
+# executing it again, which would register every table and model twice.
+if __name__ in ("__main__", "__mp_main__"):
+    sys.modules.setdefault("main", sys.modules[__name__])
 
 # --- Uvicorn Server Runner for Production ---
 if __name__ == "__main__":
     """
     This block is for running the app in a production environment (e.g., on Render).
-    It runs the `app` object directly, which prevents the double-import error.
+    It starts WEB_CONCURRENCY worker processes, each running its own event loop on
+    uvloop/httptools. Without a shared rate limit store every worker would enforce
+    its own limits, so the default is 1 worker then, and 2 * CPU cores + 1 otherwise.
     """
     port = int(os.environ.get("PORT", 8000))
-    # THE FIX: Pass the `app` object, NOT the import string "main:app".
-    uvicorn.run(app, host="0.0.0.0", port=port, reload=False)
+    default_workers = (os.cpu_count() or 1) * 2 + 1 if rate_limit_storage_uri else 1
+    workers = int(os.environ.get("WEB_CONCURRENCY", default_workers))
+    if workers > 1 and not rate_limit_storage_uri:
+        print(
+            f"Warning: running {workers} workers without RATE_LIMIT_STORAGE_URI; "
+            f"each worker enforces the rate limits separately, multiplying them by {workers}."
+        )
+    forwarded_allow_ips = os.environ.get("FORWARDED_ALLOW_IPS")
+    # Create and seed the database once here so the workers don't race to do it.
+    init_db()
+    # Multiple workers require the import string "main:app", not the `app` object.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        access_log=False,
+        log_level="warning",
+        # The client IP is also the rate limit key, and clients can write their own
+        # X-Forwarded-For entries, so only honour the header when it comes from the
+        # proxy addresses listed in FORWARDED_ALLOW_IPS.
+        proxy_headers=forwarded_allow_ips is not None,
+        forwarded_allow_ips=forwarded_allow_ips,
+    )